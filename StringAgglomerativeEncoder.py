@@ -5,6 +5,7 @@ Created on Mon Jul 29 09:28:54 2024
 @author: cego
 """
 
+import warnings
 import numpy as np
 from sklearn.base import TransformerMixin, BaseEstimator
 from sklearn.utils.validation import check_is_fitted
@@ -14,6 +15,198 @@ from scipy.spatial.distance import squareform
 from scipy.cluster.hierarchy import linkage, fcluster
 import pandas as pd
 
+try:
+    import fastcluster
+except ImportError:
+    fastcluster = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    import cupy
+    import cupyx.scipy.sparse
+except ImportError:
+    cupy = None
+
+
+def _binary_distances(A, B, metric, n_jobs=None, B_counts=None):
+    """ Computes the distances between the rows of two binarized sparse n-gram
+    matrices. The 'dice' and 'jaccard' metrics are computed directly from the
+    sparse intersections, other metrics fall back to `pairwise_distances` over
+    dense boolean arrays, split across n_jobs jobs. The n-gram counts of the rows
+    of B can be given as B_counts when they are already known.
+    """
+    if metric not in ["dice", "jaccard"]:
+        return pairwise_distances(A.toarray() > 0, B.toarray() > 0, metric=metric,
+                                  n_jobs=n_jobs)
+    
+    # the uint8 n-gram matrices are upcast so the intersection counts can't overflow
+    intersection = (A.astype(np.int32) @ B.T.astype(np.int32)).toarray()
+    a = np.asarray(A.sum(axis=1, dtype=np.int64))
+    if B_counts is None:
+        b = np.asarray(B.sum(axis=1, dtype=np.int64)).T
+    else:
+        b = B_counts[None, :]
+    
+    return _intersection_distances(intersection, a, b, metric)
+
+
+def _intersection_distances(intersection, a, b, metric):
+    """ Computes the 'dice' or 'jaccard' distances from the intersection counts
+    and the n-gram counts a and b of the compared vectors.
+    """
+    # same formulas used by scipy.spatial.distance for boolean vectors
+    numerator = a + b - 2*intersection
+    if metric == "dice":
+        denominator = a + b
+    else:
+        denominator = a + b - intersection
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dist_array = np.where(denominator != 0, numerator/denominator, 0.)
+    return dist_array
+
+
+def _condensed_binary_distances(V, metric, n_jobs=None, block_size=512):
+    """ Computes the condensed distances between the rows of a binarized sparse
+    n-gram matrix. For the 'dice' and 'jaccard' metrics, only the upper triangle
+    of the intersections is computed, one block of rows at a time.
+    """
+    if metric not in ["dice", "jaccard"]:
+        return squareform(_binary_distances(V, V, metric, n_jobs=n_jobs), checks=False)
+    
+    n = V.shape[0]
+    V = V.astype(np.int32)
+    counts = np.diff(V.indptr).astype(np.int64)
+    
+    dist_condensed = np.empty(n * (n - 1) // 2)
+    offset = 0
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        intersection = (V[start:stop] @ V[start:].T).toarray()
+        dist_block = _intersection_distances(intersection, counts[start:stop, None],
+                                             counts[None, start:], metric)
+        for i in range(start, stop):
+            dist_condensed[offset:offset + n - i - 1] = dist_block[i - start, i - start + 1:]
+            offset += n - i - 1
+    return dist_condensed
+
+
+def _gpu_condensed_distances(V, metric):
+    """ Computes the condensed 'dice' or 'jaccard' distances between the rows of a
+    binarized sparse n-gram matrix on the GPU with CuPy.
+    """
+    n = V.shape[0]
+    V_gpu = cupyx.scipy.sparse.csr_matrix(V.astype(np.float32))
+    intersection = (V_gpu @ V_gpu.T).toarray().astype(cupy.float64)
+    counts = cupy.asarray(np.diff(V.indptr), dtype=cupy.float64)
+    
+    numerator = counts[:, None] + counts[None, :] - 2*intersection
+    if metric == "dice":
+        denominator = counts[:, None] + counts[None, :]
+    else:
+        denominator = counts[:, None] + counts[None, :] - intersection
+    dist_array = cupy.where(denominator != 0, numerator/cupy.maximum(denominator, 1), 0.)
+    
+    return dist_array[cupy.triu_indices(n, k=1)].get()
+
+
+def _expand_condensed(dist_condensed, inverse):
+    """ Expands the condensed distances between distinct rows to all the rows,
+    given the inverse index that maps every row to its distinct row.
+    """
+    n, n_unique = len(inverse), inverse.max() + 1
+    
+    expanded = np.zeros(n * (n - 1) // 2)
+    if n_unique == 1:
+        return expanded
+    
+    offset = 0
+    for i in range(n - 1):
+        low = np.minimum(inverse[i], inverse[i + 1:])
+        high = np.maximum(inverse[i], inverse[i + 1:])
+        different = low != high
+        
+        # position of the (low, high) pair in the condensed distances
+        k = low * (2 * n_unique - low - 1) // 2 + high - low - 1
+        expanded[offset:offset + n - i - 1][different] = dist_condensed[k[different]]
+        offset += n - i - 1
+    return expanded
+
+
+def _unique_rows(V):
+    """ Finds the distinct rows of a binarized sparse n-gram matrix, as different
+    strings may share the same n-grams (e.g. when differing only by case). Returns
+    the position of the first occurrence of each distinct row and the inverse index
+    mapping every row to its distinct row.
+    """
+    V.sort_indices()
+    keys = [V.indices[V.indptr[i]:V.indptr[i + 1]].tobytes() for i in range(V.shape[0])]
+    inverse, _ = pd.factorize(np.array(keys, dtype=object))
+    _, unique_rows = np.unique(inverse, return_index=True)
+    return unique_rows, inverse
+
+
+def _shared_ngrams(V):
+    """ Keeps only the n-grams present in more than one row of a binarized sparse
+    n-gram matrix, as the others never contribute to an intersection. They are
+    sorted by frequency, so the bits of each row fall in fewer uint64 words.
+    """
+    frequency = np.bincount(V.indices, minlength=V.shape[1])
+    shared = np.flatnonzero(frequency > 1)
+    return V[:, shared[np.argsort(-frequency[shared], kind="stable")]]
+
+
+def _pack_rows(V):
+    """ Packs the rows of a binarized sparse n-gram matrix as bits of uint64 words.
+    """
+    packed = np.zeros((V.shape[0], (V.shape[1] + 63) // 64), dtype=np.uint64)
+    rows = np.repeat(np.arange(V.shape[0]), np.diff(V.indptr))
+    bits = np.left_shift(np.uint64(1), (V.indices % 64).astype(np.uint64))
+    np.bitwise_or.at(packed, (rows, V.indices // 64), bits)
+    return packed
+
+
+if njit is not None:
+
+    _M1 = np.uint64(0x5555555555555555)
+    _M2 = np.uint64(0x3333333333333333)
+    _M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+    _H01 = np.uint64(0x0101010101010101)
+    
+    @njit(cache=True)
+    def _popcount(x):
+        x = x - ((x >> np.uint64(1)) & _M1)
+        x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+        x = (x + (x >> np.uint64(4))) & _M4
+        return np.int64((x * _H01) >> np.uint64(56))
+    
+    @njit(parallel=True, cache=True)
+    def _packed_distances(packed, counts, jaccard):
+        """ Computes the condensed 'dice' (or 'jaccard') distances between the rows
+        of a bit-packed n-gram matrix, counting the intersections with popcounts
+        over the non-empty words of each row. The counts are the number of n-grams
+        of each row, which may include n-grams left out of the packed matrix.
+        """
+        n = packed.shape[0]
+        dist_condensed = np.empty(n * (n - 1) // 2)
+        for i in prange(n - 1):
+            offset = i * (2 * n - i - 1) // 2 - i - 1
+            words = np.nonzero(packed[i])[0]
+            for j in range(i + 1, n):
+                intersection = 0
+                for w in words:
+                    intersection += _popcount(packed[i, w] & packed[j, w])
+                numerator = counts[i] + counts[j] - 2 * intersection
+                denominator = counts[i] + counts[j]
+                if jaccard:
+                    denominator -= intersection
+                dist_condensed[offset + j] = numerator / denominator if denominator != 0 else 0.
+        return dist_condensed
+
 class StringAgglomerativeEncoder(TransformerMixin, BaseEstimator):
     """ A transformer that applies hierarchical clustering on dirty categories based on
     a given distance metric between strings.
@@ -52,6 +245,16 @@ class StringAgglomerativeEncoder(TransformerMixin, BaseEstimator):
         - 'force linkage': force the linkage fixing the clusters and assigning
         the category to the most similar cluster using the linkage_method selected.
         - 'impute nan': ignores new categories by assigning them to nan.
+    
+    use_gpu : bool, default=False
+        Compute the 'dice' or 'jaccard' distances between the categories during
+        `fit` on the GPU, which requires CuPy. If CuPy is not installed, the
+        distances are computed on the CPU.
+    
+    n_jobs : int, default=None
+        The number of jobs used by `pairwise_distances` for metrics other than
+        'dice' and 'jaccard', which are computed from the sparse n-gram intersections.
+        None means 1 and -1 means using all processors.
         
     Attributes
     ----------
@@ -76,6 +279,12 @@ class StringAgglomerativeEncoder(TransformerMixin, BaseEstimator):
     handle_unknown : bool
         The selected way at initialization by which unknown categories are handled.
     
+    use_gpu : bool
+        Whether the GPU was selected at initialization.
+    
+    n_jobs : int
+        Number of jobs selected at initialization.
+    
     categories_ : list
         Unique categories that were saw during the `fit` method.
     
@@ -100,7 +309,9 @@ class StringAgglomerativeEncoder(TransformerMixin, BaseEstimator):
                  ngram_range=(1, 3),
                  lowercase=True,
                  criterion="maxclust",
-                 handle_unknown="force linkage"):
+                 handle_unknown="force linkage",
+                 use_gpu=False,
+                 n_jobs=None):
         
         linkages_supported = ["average", "complete", "single"]
         if linkage_method not in linkages_supported:
@@ -117,6 +328,8 @@ class StringAgglomerativeEncoder(TransformerMixin, BaseEstimator):
         self.ngram_range= ngram_range
         self.lowercase = lowercase
         self.handle_unknown = handle_unknown
+        self.use_gpu = use_gpu
+        self.n_jobs = n_jobs
 
     def fit(self, X, y=None):
         """
@@ -143,24 +356,48 @@ class StringAgglomerativeEncoder(TransformerMixin, BaseEstimator):
         if X.dtypes[0] not in ["object", "string"]:
             raise TypeError("Column must have object or string dtype.")
         
-        X = pd.Series(X.values.squeeze()).sort_values()
-        
         # we care only about the unique values
+        # (np.unique already returns them sorted)
         X_unique = np.unique(X.values)
         self.categories_ = X_unique.tolist()
         
         # fitting CountVectorizer object using ngram_range options
         self.count_vectorizer_ = CountVectorizer(ngram_range=self.ngram_range, analyzer="char",
-                                                 lowercase=self.lowercase)
+                                                 lowercase=self.lowercase, binary=True,
+                                                 dtype=np.uint8)
         categories_vectorized_ = self.count_vectorizer_.fit_transform(self.categories_)
         
-        # generating distance matrix using the selected distance metric
-        dist_array = squareform(pairwise_distances((categories_vectorized_.toarray() > 0),
-                                                   metric=self.metric))
-        
-        # generating the linkages
-        Z = linkage(dist_array,
-                    method=self.linkage_method)
+        # the distances only need to be calculated between distinct n-gram vectors
+        unique_rows, inverse = _unique_rows(categories_vectorized_)
+        known_vec = categories_vectorized_[unique_rows]
+        
+        if self.use_gpu and (cupy is None):
+            warnings.warn("CuPy is not installed, the distances are computed on the CPU.")
+        
+        # generating the condensed distance matrix using the selected distance metric,
+        # on the GPU if selected or with the bit-packed kernel when numba is installed
+        if self.use_gpu and (cupy is not None) and (self.metric in ["dice", "jaccard"]):
+            dist_condensed = _gpu_condensed_distances(known_vec, self.metric)
+        elif (njit is not None) and (self.metric in ["dice", "jaccard"]):
+            dist_condensed = _packed_distances(_pack_rows(_shared_ngrams(known_vec)),
+                                               np.diff(known_vec.indptr).astype(np.int64),
+                                               self.metric == "jaccard")
+        else:
+            dist_condensed = _condensed_binary_distances(known_vec, metric=self.metric,
+                                                         n_jobs=self.n_jobs)
+        
+        # categories sharing the same n-gram vector get the same distances
+        if len(unique_rows) < len(inverse):
+            dist_condensed = _expand_condensed(dist_condensed, inverse)
+        
+        # generating the linkages, with fastcluster when it is installed
+        if fastcluster is not None:
+            Z = fastcluster.linkage(dist_condensed,
+                                    method=self.linkage_method,
+                                    preserve_input=False)
+        else:
+            Z = linkage(dist_condensed,
+                        method=self.linkage_method)
         self.Z_ = Z
         
         # getting respective clusters using t and criterion
@@ -175,6 +412,20 @@ class StringAgglomerativeEncoder(TransformerMixin, BaseEstimator):
                         for i in range(len(clusters))}
         self.string_cluster_dict_ = replace_dict
 
+        # caching the distinct n-gram vectors and the cluster grouping, so unknown
+        # categories can be linked to the clusters in a single batch during transform
+        self._known_vec_ = known_vec
+        self._known_pop_ = np.diff(known_vec.indptr).astype(np.int64)
+        
+        # each distinct n-gram vector enters the reduction of its cluster only once,
+        # weighted by the number of categories sharing it
+        cluster_columns, self._cluster_weights_ = np.unique(np.column_stack([clusters, inverse]),
+                                                            axis=0, return_counts=True)
+        self._cluster_columns_ = cluster_columns[:, 1]
+        self._cluster_ids_, self._cluster_offsets_ = np.unique(cluster_columns[:, 0].astype(clusters.dtype),
+                                                               return_index=True)
+        self._cluster_sizes_ = np.add.reduceat(self._cluster_weights_, self._cluster_offsets_)
+        
         return self
 
     def transform(self, X):
@@ -201,7 +452,7 @@ class StringAgglomerativeEncoder(TransformerMixin, BaseEstimator):
         
         check_is_fitted(self, 'string_cluster_dict_')
         
-        X = pd.Series(X.values.squeeze())
+        X = pd.Series(X.values.ravel())
         
         # we care only about the unique categories
         X_unique = np.unique(X.values).tolist()
@@ -214,37 +465,44 @@ class StringAgglomerativeEncoder(TransformerMixin, BaseEstimator):
         unknown_values_dict = {}
         if (len(unknown_values) != 0) and (self.handle_unknown == "force linkage"):
             
-            string_cluster_df = pd.DataFrame({"string": list(self.string_cluster_dict_.keys()),
-                                              "cluster": list(self.string_cluster_dict_.values())})
+            # vectorizing all the unknown categories at once
+            unknown_vectorized = self.count_vectorizer_.transform(unknown_values)
             
-            for unknown_value in unknown_values:
-                
-                def get_distance(str_):
-                    str1_vectorized = self.count_vectorizer_.transform([str_]).toarray() > 0
-                    str2_vectorized = self.count_vectorizer_.transform([unknown_value]).toarray() > 0
-                    return pairwise_distances(str1_vectorized,
-                                              str2_vectorized, metric=self.metric)[0][0]
-                
-                string_cluster_df["dist"] = string_cluster_df["string"].apply(get_distance)
-                
-                if self.linkage_method == "average":
-                    dist_cluster = string_cluster_df.groupby(by="cluster")["dist"].mean()
-                elif self.linkage_method == "complete":
-                    dist_cluster = string_cluster_df.groupby(by="cluster")["dist"].max()
-                elif self.linkage_method == "single":
-                    dist_cluster = string_cluster_df.groupby(by="cluster")["dist"].min()
-                    
-                predicted_cluster = dist_cluster.idxmin()
-                
-                unknown_values_dict[unknown_value] = predicted_cluster
+            # distances between each unknown category and the known categories,
+            # with the columns grouped by cluster
+            dist_array = _binary_distances(unknown_vectorized, self._known_vec_,
+                                           metric=self.metric, n_jobs=self.n_jobs,
+                                           B_counts=self._known_pop_)
+            dist_array = dist_array[:, self._cluster_columns_]
+            
+            if self.linkage_method == "average":
+                dist_cluster = np.add.reduceat(dist_array*self._cluster_weights_,
+                                               self._cluster_offsets_, axis=1) / self._cluster_sizes_
+            elif self.linkage_method == "complete":
+                dist_cluster = np.maximum.reduceat(dist_array, self._cluster_offsets_, axis=1)
+            elif self.linkage_method == "single":
+                dist_cluster = np.minimum.reduceat(dist_array, self._cluster_offsets_, axis=1)
+            
+            predicted_clusters = self._cluster_ids_[dist_cluster.argmin(axis=1)]
+            
+            unknown_values_dict = {unknown_value: predicted_cluster for unknown_value, predicted_cluster\
+                                   in zip(unknown_values, predicted_clusters)}
         
         elif (len(unknown_values) != 0) and (self.handle_unknown == "impute nan"):
             
             for unknown_value in unknown_values:
                 unknown_values_dict[unknown_value] = np.nan
         
-        return X.replace(self.string_cluster_dict_)\
-                .replace(unknown_values_dict).values.reshape(-1, 1)
+        # mapping every category to its cluster through the categorical codes
+        string_cluster_dict = {**self.string_cluster_dict_, **unknown_values_dict}
+        clusters = np.array(list(string_cluster_dict.values()))
+        codes = pd.Categorical(X.values, categories=list(string_cluster_dict.keys())).codes
+        
+        # values that could not be mapped (code -1) are assigned to nan
+        if (codes == -1).any():
+            clusters = np.append(clusters.astype(float), np.nan)
+        
+        return clusters[codes].reshape(-1, 1)
     
     def fit_transform(self, X, y=None):
         """
@@ -11,8 +11,54 @@ from sklearn.utils.validation import check_is_fitted
 from sklearn.feature_extraction.text import CountVectorizer
 from sklearn.metrics import pairwise_distances
 from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
 import pandas as pd
 
+
+def _binary_distances(A, B, metric, n_jobs=None, B_counts=None):
+    """ Computes the distances between the rows of two binarized sparse n-gram
+    matrices. The 'dice' and 'jaccard' metrics are computed directly from the
+    sparse intersections, other metrics fall back to `pairwise_distances` over
+    dense boolean arrays, split across n_jobs jobs. The n-gram counts of the rows
+    of B can be given as B_counts when they are already known.
+    """
+    if metric not in ["dice", "jaccard"]:
+        return pairwise_distances(A.toarray() > 0, B.toarray() > 0, metric=metric,
+                                  n_jobs=n_jobs)
+    
+    # the uint8 n-gram matrices are upcast so the intersection counts can't overflow
+    intersection = (A.astype(np.int32) @ B.T.astype(np.int32)).toarray()
+    a = np.asarray(A.sum(axis=1, dtype=np.int64))
+    if B_counts is None:
+        b = np.asarray(B.sum(axis=1, dtype=np.int64)).T
+    else:
+        b = B_counts[None, :]
+    
+    # same formulas used by scipy.spatial.distance for boolean vectors
+    numerator = a + b - 2*intersection
+    if metric == "dice":
+        denominator = a + b
+    else:
+        denominator = a + b - intersection
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dist_array = np.where(denominator != 0, numerator/denominator, 0.)
+    return dist_array
+
+
+def _unique_rows(V):
+    """ Finds the distinct rows of a binarized sparse n-gram matrix, as different
+    strings may share the same n-grams (e.g. when differing only by case). Returns
+    the position of the first occurrence of each distinct row and the inverse index
+    mapping every row to its distinct row.
+    """
+    V.sort_indices()
+    keys = [V.indices[V.indptr[i]:V.indptr[i + 1]].tobytes() for i in range(V.shape[0])]
+    inverse, _ = pd.factorize(np.array(keys, dtype=object))
+    _, unique_rows = np.unique(inverse, return_index=True)
+    return unique_rows, inverse
+
+
 class StringDistanceEncoder(TransformerMixin, BaseEstimator):
     """ A transformer that encodes dirty categories by using n-grams and the distance
     between the strings.
@@ -23,10 +69,13 @@ class StringDistanceEncoder(TransformerMixin, BaseEstimator):
         Number of components to be extracted by TruncatedSVD applied to the
         n-gram matrix.
     
-    metric : str, default='dice'
+    metric : str, default=None
         The metric to use when calculating distance between the categories.
+        If None, TruncatedSVD is applied directly to the L2-normalized n-gram
+        matrix, which avoids computing the distance matrix between all the categories.
         If metric is a string, it must be one of the options allowed by scipy.spatial.distance.pdist
-        for its metric parameter, or a metric listed in sklearn.pairwise.PAIRWISE_DISTANCE_FUNCTIONS.
+        for its metric parameter, or a metric listed in sklearn.pairwise.PAIRWISE_DISTANCE_FUNCTIONS,
+        and TruncatedSVD is applied to the distance matrix.
     
     ngram_range : tuple (min_n, max_n), default=(3, 3)
         The lower and upper boundary of the range of n-values for different char
@@ -35,6 +84,11 @@ class StringDistanceEncoder(TransformerMixin, BaseEstimator):
         
     lowercase : bool, default=True
         Convert all characters to lowercase before tokenizing.
+    
+    n_jobs : int, default=None
+        The number of jobs used by `pairwise_distances` for metrics other than
+        'dice' and 'jaccard', which are computed from the sparse n-gram intersections.
+        None means 1 and -1 means using all processors.
         
     Attributes
     ----------
@@ -44,28 +98,33 @@ class StringDistanceEncoder(TransformerMixin, BaseEstimator):
     ngram_range : tuple
         n-gram range selected at initialization.
     
+    n_jobs : int
+        Number of jobs selected at initialization.
+    
     categories_ : list
         Unique categories that were saw during the `fit` method.
     
     count_vectorizer_ : class
         Respective CountVectorizer object.
         
-    categories_vectorized_ : array, shape (n_samples, n_grams)
-        Output of count_vectorizer_ object over categories_ list.
+    categories_vectorized_ : sparse matrix, shape (n_samples, n_grams)
+        Binarized output of count_vectorizer_ object over categories_ list.
     
     truncated_svd : class
         Fitted TruncatedSVD object.
     """
     def __init__(self,
                  n_components=2,
-                 metric="dice",
+                 metric=None,
                  ngram_range=(1, 3),
-                 lowercase=True):
+                 lowercase=True,
+                 n_jobs=None):
         
         self.n_components = n_components
         self.metric = metric
         self.ngram_range= ngram_range
         self.lowercase = lowercase
+        self.n_jobs = n_jobs
 
     def fit(self, X, y=None):
         """
@@ -92,25 +151,42 @@ class StringDistanceEncoder(TransformerMixin, BaseEstimator):
         if X.dtypes[0] not in ["object", "string"]:
             raise TypeError("Column must have object or string dtype.")
         
-        X = pd.Series(X.values.squeeze()).sort_values()
-        
         # we care only about the unique categories
+        # (np.unique already returns them sorted)
         X_unique = np.unique(X.values)
         self.categories_ = X_unique.tolist()
         
         # fitting CountVectorizer object using ngram_range options
         self.count_vectorizer_ = CountVectorizer(ngram_range=self.ngram_range, analyzer="char",
-                                                 lowercase=self.lowercase)
-        self.categories_vectorized_ = self.count_vectorizer_.fit_transform(self.categories_).toarray() > 0
+                                                 lowercase=self.lowercase, binary=True,
+                                                 dtype=np.uint8)
+        self.categories_vectorized_ = self.count_vectorizer_.fit_transform(self.categories_)
+        
+        if self.metric is None:
         
-        # generating distance matrix using the selected distance metric
-        dist_array = pairwise_distances(self.categories_vectorized_,
-                                        metric=self.metric)
+            # the L2-normalized n-gram matrix is decomposed directly
+            svd_input = normalize(self.categories_vectorized_)
+        
+        else:
+            
+            # the distances only need to be calculated between distinct n-gram vectors
+            unique_rows, self._dedup_inverse_ = _unique_rows(self.categories_vectorized_)
+            self._known_vec_ = self.categories_vectorized_[unique_rows]
+            self._known_pop_ = np.diff(self._known_vec_.indptr).astype(np.int64)
+            
+            # generating distance matrix using the selected distance metric
+            dist_array = _binary_distances(self._known_vec_,
+                                           self._known_vec_,
+                                           metric=self.metric, n_jobs=self.n_jobs,
+                                           B_counts=self._known_pop_)
+            svd_input = dist_array[np.ix_(self._dedup_inverse_, self._dedup_inverse_)]
         
         # fitting and storing the TruncatedSVD object
         truncated_svd = TruncatedSVD(n_components=self.n_components,
-                                     algorithm="arpack")
-        truncated_svd.fit(dist_array)
+                                     algorithm="randomized",
+                                     n_iter=5,
+                                     random_state=0)
+        self._known_transformed_ = truncated_svd.fit_transform(svd_input)
         self.truncated_svd = truncated_svd
         
         return self
@@ -141,28 +217,41 @@ class StringDistanceEncoder(TransformerMixin, BaseEstimator):
         
         check_is_fitted(self, 'truncated_svd')
         
-        X = pd.Series(X.values.squeeze())
+        X = pd.Series(X.values.ravel())
         
         # we care only about the unique categories
         X_unique = np.unique(X.values).tolist()
         
-        # vectorizing X using the fitted count_vectorizer_ object
-        X_unique_vectorized = self.count_vectorizer_.transform(X_unique).toarray() > 0
-        
-        # calculating the distances between the categories in X and the categories
-        # that were already seen before
-        dist_array = pairwise_distances(X_unique_vectorized,
-                                        self.categories_vectorized_,
-                                        metric=self.metric)
+        # categories that were seen during fit reuse the cached transformation
+        known_index = pd.Index(self.categories_).get_indexer(X_unique)
+        is_known = known_index != -1
+        X_unique_transformed = np.empty((len(X_unique), self._known_transformed_.shape[1]))
+        X_unique_transformed[is_known] = self._known_transformed_[known_index[is_known]]
         
-        # applying dimensionality reduction to the X_unique
-        X_unique_transformed = self.truncated_svd.transform(dist_array)
+        if not is_known.all():
+            
+            # vectorizing the new categories using the fitted count_vectorizer_ object
+            new_categories = [category for category, known in zip(X_unique, is_known) if not known]
+            new_vectorized = self.count_vectorizer_.transform(new_categories)
+            
+            if self.metric is None:
+                svd_input = normalize(new_vectorized)
+            else:
+                # calculating the distances between the new categories and the categories
+                # that were already seen before
+                dist_array = _binary_distances(new_vectorized,
+                                               self._known_vec_,
+                                               metric=self.metric, n_jobs=self.n_jobs,
+                                               B_counts=self._known_pop_)
+                svd_input = dist_array[:, self._dedup_inverse_]
+            
+            # applying dimensionality reduction to the new categories
+            X_unique_transformed[~is_known] = self.truncated_svd.transform(svd_input)
         
         # but now we need to put X in the original shape
-        X_transformed = np.zeros((len(X), X_unique_transformed.shape[-1]))
-        for i, category in enumerate(X_unique):
-            cond = (X == category).values
-            X_transformed[cond, :] = X_unique_transformed[i, :]
+        # by gathering the rows through the codes of each category
+        codes = pd.Categorical(X.values, categories=X_unique).codes
+        X_transformed = X_unique_transformed[codes]
         
         return X_transformed
     